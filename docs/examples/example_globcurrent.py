@@ -1,5 +1,5 @@
+import functools
 from datetime import timedelta as delta
-from glob import glob
 
 import numpy as np
 import pytest
@@ -18,25 +18,57 @@ from parcels import (
 )
 
 ptype = {'scipy': ScipyParticle, 'jit': JITParticle}
+lon0 = np.array([25.])
+lat0 = np.array([-35.])
 
 
 def set_globcurrent_fieldset(filename=None, indices=None, deferred_load=True, use_xarray=False, time_periodic=False, timestamps=None):
     if filename is None:
         data_folder = download_example_dataset("GlobCurrent_example_data")
-        filename = str(data_folder / '2002*-GLOBCURRENT-L4-CUReul_hs-ALT_SUM-v02.0-fv01.0.nc')
+        filename = sorted(data_folder.glob('2002*-GLOBCURRENT-L4-CUReul_hs-ALT_SUM-v02.0-fv01.0.nc'))
     variables = {'U': 'eastward_eulerian_current_velocity', 'V': 'northward_eulerian_current_velocity'}
     if timestamps is None:
         dimensions = {'lat': 'lat', 'lon': 'lon', 'time': 'time'}
     else:
         dimensions = {'lat': 'lat', 'lon': 'lon'}
     if use_xarray:
-        ds = xr.open_mfdataset(filename, combine='by_coords')
+        ds = xr.open_mfdataset(filename, combine='by_coords', parallel=True,
+                               data_vars='minimal', coords='minimal', compat='override', decode_coords=False)
         return FieldSet.from_xarray_dataset(ds, variables, dimensions, time_periodic=time_periodic)
     else:
         return FieldSet.from_netcdf(filename, variables, dimensions, indices, deferred_load=deferred_load, time_periodic=time_periodic, timestamps=timestamps)
 
 
-@pytest.mark.parametrize('use_xarray', [True, False])
+@pytest.fixture(scope="session")
+def globcurrent_folder():
+    return download_example_dataset("GlobCurrent_example_data")
+
+
+@pytest.fixture(scope="session")
+def globcurrent_files(globcurrent_folder):
+    return sorted(globcurrent_folder.glob('20*-GLOBCURRENT-L4-CUReul_hs-ALT_SUM-v02.0-fv01.0.nc'))
+
+
+@pytest.fixture(scope="session")
+def default_fieldset(globcurrent_files):
+    """Return a function giving the default FieldSet of either backend, built at most once per session."""
+    # only for tests that do not add Fields to the FieldSet or make it time-periodic
+    files2002 = [f for f in globcurrent_files if f.name.startswith('2002')]
+    fieldsets = {}
+
+    def get_fieldset(use_xarray=False):
+        if use_xarray not in fieldsets:
+            fieldsets[use_xarray] = set_globcurrent_fieldset(files2002, use_xarray=use_xarray)
+        return fieldsets[use_xarray]
+    return get_fieldset
+
+
+@pytest.fixture(name="use_xarray", params=[False, pytest.param(True, marks=pytest.mark.xarray_backend)], ids=['netcdf', 'xarray'])
+def use_xarray_fixture(request):
+    # the xarray cases are deselected by default, as test_globcurrent_xarray_vs_netcdf already checks both backends agree
+    return request.param
+
+
 def test_globcurrent_fieldset(use_xarray):
     fieldset = set_globcurrent_fieldset(use_xarray=use_xarray)
     assert fieldset.U.lon.size == 81
@@ -45,7 +77,7 @@ def test_globcurrent_fieldset(use_xarray):
     assert fieldset.V.lat.size == 41
 
     if not use_xarray:
-        indices = {'lon': [5], 'lat': range(20, 30)}
+        indices = {'lon': range(5, 6), 'lat': range(20, 30)}
         fieldsetsub = set_globcurrent_fieldset(indices=indices, use_xarray=use_xarray)
         assert np.allclose(fieldsetsub.U.lon, fieldset.U.lon[indices['lon']])
         assert np.allclose(fieldsetsub.U.lat, fieldset.U.lat[indices['lat']])
@@ -53,19 +85,14 @@ def test_globcurrent_fieldset(use_xarray):
         assert np.allclose(fieldsetsub.V.lat, fieldset.V.lat[indices['lat']])
 
 
-@pytest.mark.parametrize('mode', ['scipy', 'jit'])
 @pytest.mark.parametrize('dt, lonstart, latstart', [(3600., 25, -35), (-3600., 20, -39)])
-@pytest.mark.parametrize('use_xarray', [True, False])
-def test_globcurrent_fieldset_advancetime(mode, dt, lonstart, latstart, use_xarray):
-    data_folder = download_example_dataset("GlobCurrent_example_data")
-    basepath = str(data_folder / '20*-GLOBCURRENT-L4-CUReul_hs-ALT_SUM-v02.0-fv01.0.nc')
-    files = sorted(glob(str(basepath)))
-
-    fieldsetsub = set_globcurrent_fieldset(files[0:10], use_xarray=use_xarray)
-    psetsub = ParticleSet.from_list(fieldset=fieldsetsub, pclass=ptype[mode], lon=[lonstart], lat=[latstart])
+def test_globcurrent_fieldset_advancetime(dt, lonstart, latstart, globcurrent_files):
+    # compares deferred loading against loading all data at once; only the netcdf path supports deferred_load
+    fieldsetsub = set_globcurrent_fieldset(globcurrent_files[0:10])
+    psetsub = ParticleSet.from_list(fieldset=fieldsetsub, pclass=JITParticle, lon=[lonstart], lat=[latstart])
 
-    fieldsetall = set_globcurrent_fieldset(files[0:10], deferred_load=False, use_xarray=use_xarray)
-    psetall = ParticleSet.from_list(fieldset=fieldsetall, pclass=ptype[mode], lon=[lonstart], lat=[latstart])
+    fieldsetall = set_globcurrent_fieldset(globcurrent_files[0:10], deferred_load=False)
+    psetall = ParticleSet.from_list(fieldset=fieldsetall, pclass=JITParticle, lon=[lonstart], lat=[latstart])
     if dt < 0:
         psetsub[0].time_nextloop = fieldsetsub.U.grid.time[-1]
         psetall[0].time_nextloop = fieldsetall.U.grid.time[-1]
@@ -76,15 +103,10 @@ def test_globcurrent_fieldset_advancetime(mode, dt, lonstart, latstart, use_xarr
     assert abs(psetsub[0].lon - psetall[0].lon) < 1e-4
 
 
-@pytest.mark.parametrize('mode', ['scipy', 'jit'])
-@pytest.mark.parametrize('use_xarray', [True, False])
-def test_globcurrent_particles(mode, use_xarray):
+def test_globcurrent_particles(use_xarray):
     fieldset = set_globcurrent_fieldset(use_xarray=use_xarray)
 
-    lonstart = [25]
-    latstart = [-35]
-
-    pset = ParticleSet(fieldset, pclass=ptype[mode], lon=lonstart, lat=latstart)
+    pset = ParticleSet(fieldset, pclass=JITParticle, lon=lon0, lat=lat0)
 
     pset.execute(AdvectionRK4, runtime=delta(days=1), dt=delta(minutes=5))
 
@@ -92,42 +114,67 @@ def test_globcurrent_particles(mode, use_xarray):
     assert abs(pset[0].lat - -35.3) < 1
 
 
-@pytest.mark.parametrize('mode', ['scipy', 'jit'])
-@pytest.mark.parametrize('rundays', [300, 900])
-def test_globcurrent_time_periodic(mode, rundays):
-    sample_var = []
-    for deferred_load in [True, False]:
-        fieldset = set_globcurrent_fieldset(time_periodic=delta(days=365), deferred_load=deferred_load)
+def test_scipy_mode_smoke(default_fieldset):
+    # the advection tests above only run in JIT mode; check that scipy mode gives the same result
+    fieldset = default_fieldset()
+
+    psetS = ParticleSet(fieldset, pclass=ScipyParticle, lon=lon0, lat=lat0)
+    psetS.execute(AdvectionRK4, runtime=delta(days=1), dt=delta(minutes=5))
+
+    psetJ = ParticleSet(fieldset, pclass=JITParticle, lon=lon0, lat=lat0)
+    psetJ.execute(AdvectionRK4, runtime=delta(days=1), dt=delta(minutes=5))
+
+    assert np.allclose(psetS.lon, psetJ.lon)
+    assert np.allclose(psetS.lat, psetJ.lat)
+
 
-        class MyParticle(ptype[mode]):
-            sample_var = Variable('sample_var', initial=0.)
+@functools.lru_cache(maxsize=None)
+def run_globcurrent_time_periodic(mode, rundays, deferred_load):
+    """Sum of U sampled daily at a fixed location over rundays of a time-periodic FieldSet."""
+    fieldset = set_globcurrent_fieldset(time_periodic=delta(days=365), deferred_load=deferred_load)
 
-        pset = ParticleSet(fieldset, pclass=MyParticle, lon=25, lat=-35, time=fieldset.U.grid.time[0])
+    class MyParticle(ptype[mode]):
+        sample_var = Variable('sample_var', initial=0.)
+
+    pset = ParticleSet(fieldset, pclass=MyParticle, lon=lon0, lat=lat0, time=fieldset.U.grid.time[0])
 
-        def SampleU(particle, fieldset, time):
-            u, v = fieldset.UV[time, particle.depth, particle.lat, particle.lon]
-            particle.sample_var += u
+    def SampleU(particle, fieldset, time):
+        particle.sample_var += fieldset.U[time, particle.depth, particle.lat, particle.lon]
 
-        pset.execute(SampleU, runtime=delta(days=rundays), dt=delta(days=1))
-        sample_var.append(pset[0].sample_var)
+    pset.execute(SampleU, runtime=delta(days=rundays), dt=delta(days=1))
+    return pset[0].sample_var
 
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+@pytest.mark.parametrize('rundays', [300, pytest.param(900, marks=pytest.mark.slow)])
+@pytest.mark.parametrize('deferred_load', [True, False])
+def test_globcurrent_time_periodic(mode, rundays, deferred_load):
+    assert np.isfinite(run_globcurrent_time_periodic(mode, rundays, deferred_load))
+
+
+@pytest.mark.parametrize('mode', ['scipy', 'jit'])
+@pytest.mark.parametrize('rundays', [300, pytest.param(900, marks=pytest.mark.slow)])
+def test_globcurrent_time_periodic_consistency(mode, rundays):
+    # reuses the results of test_globcurrent_time_periodic when run in the same process, and computes them otherwise
+    sample_var = [run_globcurrent_time_periodic(mode, rundays, deferred_load) for deferred_load in [True, False]]
     assert np.allclose(sample_var[0], sample_var[1])
 
 
 @pytest.mark.parametrize('dt', [-300, 300])
-def test_globcurrent_xarray_vs_netcdf(dt):
-    fieldsetNetcdf = set_globcurrent_fieldset(use_xarray=False)
-    fieldsetxarray = set_globcurrent_fieldset(use_xarray=True)
-    lonstart, latstart, runtime = (25, -35, delta(days=7))
+def test_globcurrent_xarray_vs_netcdf(dt, default_fieldset):
+    fieldsetNetcdf = default_fieldset(use_xarray=False)
+    fieldsetxarray = default_fieldset(use_xarray=True)
 
-    psetN = ParticleSet(fieldsetNetcdf, pclass=JITParticle, lon=lonstart, lat=latstart)
-    psetN.execute(AdvectionRK4, runtime=runtime, dt=dt)
+    psetN = ParticleSet(fieldsetNetcdf, pclass=JITParticle, lon=lon0, lat=lat0)
+    psetX = ParticleSet(fieldsetxarray, pclass=JITParticle, lon=lon0, lat=lat0)
 
-    psetX = ParticleSet(fieldsetxarray, pclass=JITParticle, lon=lonstart, lat=latstart)
-    psetX.execute(AdvectionRK4, runtime=runtime, dt=dt)
+    # two days cross two daily field snapshots; compare after each day to catch divergence early
+    for _ in range(2):
+        psetN.execute(AdvectionRK4, runtime=delta(days=1), dt=dt)
+        psetX.execute(AdvectionRK4, runtime=delta(days=1), dt=dt)
 
-    assert np.allclose(psetN[0].lon, psetX[0].lon)
-    assert np.allclose(psetN[0].lat, psetX[0].lat)
+        assert np.allclose(psetN[0].lon, psetX[0].lon)
+        assert np.allclose(psetN[0].lat, psetX[0].lat)
 
 
 @pytest.mark.parametrize('dt', [-300, 300])
@@ -135,62 +182,63 @@ def test_globcurrent_netcdf_timestamps(dt):
     fieldsetNetcdf = set_globcurrent_fieldset()
     timestamps = fieldsetNetcdf.U.grid.timeslices
     fieldsetTimestamps = set_globcurrent_fieldset(timestamps=timestamps)
-    lonstart, latstart, runtime = (25, -35, delta(days=7))
+    runtime = delta(days=7)
 
-    psetN = ParticleSet(fieldsetNetcdf, pclass=JITParticle, lon=lonstart, lat=latstart)
+    psetN = ParticleSet(fieldsetNetcdf, pclass=JITParticle, lon=lon0, lat=lat0)
     psetN.execute(AdvectionRK4, runtime=runtime, dt=dt)
 
-    psetT = ParticleSet(fieldsetTimestamps, pclass=JITParticle, lon=lonstart, lat=latstart)
+    psetT = ParticleSet(fieldsetTimestamps, pclass=JITParticle, lon=lon0, lat=lat0)
     psetT.execute(AdvectionRK4, runtime=runtime, dt=dt)
 
     assert np.allclose(psetN.lon[0], psetT.lon[0])
     assert np.allclose(psetN.lat[0], psetT.lat[0])
 
 
-def test__particles_init_time():
-    fieldset = set_globcurrent_fieldset()
-
-    lonstart = [25]
-    latstart = [-35]
+def test__particles_init_time(default_fieldset):
+    fieldset = default_fieldset()
 
     # tests the different ways of initialising the time of a particle
-    pset = ParticleSet(fieldset, pclass=JITParticle, lon=lonstart, lat=latstart, time=np.datetime64('2002-01-15'))
-    pset2 = ParticleSet(fieldset, pclass=JITParticle, lon=lonstart, lat=latstart, time=14*86400)
-    pset3 = ParticleSet(fieldset, pclass=JITParticle, lon=lonstart, lat=latstart, time=np.array([np.datetime64('2002-01-15')]))
-    pset4 = ParticleSet(fieldset, pclass=JITParticle, lon=lonstart, lat=latstart, time=[np.datetime64('2002-01-15')])
+    pset = ParticleSet(fieldset, pclass=JITParticle, lon=lon0, lat=lat0, time=np.datetime64('2002-01-15'))
+    pset2 = ParticleSet(fieldset, pclass=JITParticle, lon=lon0, lat=lat0, time=14*86400)
+    pset3 = ParticleSet(fieldset, pclass=JITParticle, lon=lon0, lat=lat0, time=np.array([np.datetime64('2002-01-15')]))
+    pset4 = ParticleSet(fieldset, pclass=JITParticle, lon=lon0, lat=lat0, time=[np.datetime64('2002-01-15')])
     assert pset[0].time - pset2[0].time == 0
     assert pset[0].time - pset3[0].time == 0
     assert pset[0].time - pset4[0].time == 0
 
 
+def test__particles_init_time_vectorized(default_fieldset):
+    fieldset = default_fieldset()
+
+    # time as a datetime64[ns] array, the form in which xarray and pandas hand out times
+    time = np.array([np.datetime64('2002-01-15', 'ns')] * 2, dtype='datetime64[ns]')
+    pset = ParticleSet(fieldset, pclass=JITParticle, lon=np.repeat(lon0, 2), lat=np.repeat(lat0, 2), time=time)
+    assert np.allclose(pset.time, 14*86400)
+
+
 @pytest.mark.xfail(reason="Time extrapolation error expected to be thrown", strict=True)
-@pytest.mark.parametrize('mode', ['scipy', 'jit'])
-@pytest.mark.parametrize('use_xarray', [True, False])
-def test_globcurrent_time_extrapolation_error(mode, use_xarray):
-    fieldset = set_globcurrent_fieldset(use_xarray=use_xarray)
+def test_globcurrent_time_extrapolation_error(use_xarray, default_fieldset):
+    fieldset = default_fieldset(use_xarray=use_xarray)
 
-    pset = ParticleSet(fieldset, pclass=ptype[mode], lon=[25], lat=[-35],
-                       time=fieldset.U.time[0]-delta(days=1).total_seconds())
+    pset = ParticleSet(fieldset, pclass=JITParticle, lon=lon0, lat=lat0,
+                       time=fieldset.U.grid.time_full[0]-delta(days=1).total_seconds())
 
     pset.execute(AdvectionRK4, runtime=delta(days=1), dt=delta(minutes=5))
 
 
-@pytest.mark.parametrize('mode', ['scipy', 'jit'])
-@pytest.mark.parametrize('use_xarray', [True, False])
-def test_globcurrent_dt0(mode, use_xarray):
-    fieldset = set_globcurrent_fieldset(use_xarray=use_xarray)
-    pset = ParticleSet(fieldset, pclass=ptype[mode], lon=[25], lat=[-35])
+def test_globcurrent_dt0(use_xarray, default_fieldset):
+    fieldset = default_fieldset(use_xarray=use_xarray)
+    pset = ParticleSet(fieldset, pclass=JITParticle, lon=lon0, lat=lat0)
     pset.execute(AdvectionRK4, dt=0.)
 
 
 @pytest.mark.parametrize('mode', ['scipy', 'jit'])
 @pytest.mark.parametrize('dt', [-300, 300])
 @pytest.mark.parametrize('with_starttime', [True, False])
-def test_globcurrent_startparticles_between_time_arrays(mode, dt, with_starttime):
+def test_globcurrent_startparticles_between_time_arrays(mode, dt, with_starttime, globcurrent_files):
     fieldset = set_globcurrent_fieldset()
 
-    data_folder = download_example_dataset("GlobCurrent_example_data")
-    fnamesFeb = sorted(glob(f"{data_folder}/200202*.nc"))
+    fnamesFeb = [f for f in globcurrent_files if f.name.startswith('200202')]
     fieldset.add_field(Field.from_netcdf(fnamesFeb, ('P', 'eastward_eulerian_current_velocity'),
                                          {'lat': 'lat', 'lon': 'lon', 'time': 'time'}))
 
@@ -201,10 +249,11 @@ def test_globcurrent_startparticles_between_time_arrays(mode, dt, with_starttime
         particle.sample_var += fieldset.P[time, particle.depth, particle.lat, particle.lon]
 
     if with_starttime:
-        time = fieldset.U.grid.time[0] if dt > 0 else fieldset.U.grid.time[-1]
-        pset = ParticleSet(fieldset, pclass=MyParticle, lon=[25], lat=[-35], time=time)
+        gridtime = fieldset.U.grid.time
+        time = gridtime[0] if dt > 0 else gridtime[-1]
+        pset = ParticleSet(fieldset, pclass=MyParticle, lon=lon0, lat=lat0, time=time)
     else:
-        pset = ParticleSet(fieldset, pclass=MyParticle, lon=[25], lat=[-35])
+        pset = ParticleSet(fieldset, pclass=MyParticle, lon=lon0, lat=lat0)
 
     if with_starttime:
         with pytest.raises(TimeExtrapolationError):
@@ -223,8 +272,8 @@ def test_globcurrent_particle_independence(mode, rundays=5):
             particle.delete()
 
     pset0 = ParticleSet(fieldset, pclass=ptype[mode],
-                        lon=[25, 25],
-                        lat=[-35, -35],
+                        lon=np.array([25., 25.]),
+                        lat=np.array([-35., -35.]),
                         time=time0)
 
     pset0.execute(pset0.Kernel(DeleteP0)+AdvectionRK4,
@@ -232,15 +281,15 @@ def test_globcurrent_particle_independence(mode, rundays=5):
                   dt=delta(minutes=5))
 
     pset1 = ParticleSet(fieldset, pclass=ptype[mode],
-                        lon=[25, 25],
-                        lat=[-35, -35],
+                        lon=np.array([25., 25.]),
+                        lat=np.array([-35., -35.]),
                         time=time0)
 
     pset1.execute(AdvectionRK4,
                   runtime=delta(days=rundays),
                   dt=delta(minutes=5))
 
-    assert np.allclose([pset0[-1].lon, pset0[-1].lat], [pset1[-1].lon, pset1[-1].lat])
+    assert np.allclose([pset0.lon[-1], pset0.lat[-1]], [pset1.lon[-1], pset1.lat[-1]])
 
 
 @pytest.mark.parametrize('mode', ['scipy', 'jit'])
@@ -251,8 +300,9 @@ def test_globcurrent_pset_fromfile(mode, dt, pid_offset, tmpdir):
     fieldset = set_globcurrent_fieldset()
 
     ptype[mode].setLastID(pid_offset)
-    pset = ParticleSet(fieldset, pclass=ptype[mode], lon=25, lat=-35)
-    pfile = pset.ParticleFile(filename, outputdt=delta(hours=6))
+    pset = ParticleSet(fieldset, pclass=ptype[mode], lon=lon0, lat=lat0)
+    # one chunk large enough for all output steps, so the zarr store is not extended on every write
+    pfile = pset.ParticleFile(filename, outputdt=delta(hours=6), chunks=(1, 8))
     pset.execute(AdvectionRK4, runtime=delta(days=1), dt=dt, output_file=pfile)
     pfile.write_latest_locations(pset, max(pset.time_nextloop))
 
@@ -262,4 +312,4 @@ def test_globcurrent_pset_fromfile(mode, dt, pid_offset, tmpdir):
     pset_new.execute(AdvectionRK4, runtime=delta(days=1), dt=dt)
 
     for var in ['lon', 'lat', 'depth', 'time', 'id']:
-        assert np.allclose([getattr(p, var) for p in pset], [getattr(p, var) for p in pset_new])
+        assert np.allclose(getattr(pset, var), getattr(pset_new, var))
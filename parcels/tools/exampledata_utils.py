@@ -142,13 +142,26 @@ def download_example_dataset(dataset: str, data_home=None):
     cache_folder = get_data_home(data_home)
     dataset_folder = Path(cache_folder) / dataset
 
-    if not dataset_folder.exists():
-        dataset_folder.mkdir(parents=True)
+    dataset_folder.mkdir(parents=True, exist_ok=True)
 
     for filename in example_data_files[dataset]:
         filepath = dataset_folder / filename
         if not filepath.exists():
             url = f"{example_data_url}/{dataset}/{filename}"
-            urlretrieve(url, str(filepath))
+            # Download to a process-specific file first, so that concurrent callers
+            # (e.g. pytest-xdist workers) never see a partially written file
+            partpath = dataset_folder / f"{filename}.{os.getpid()}.part"
+            try:
+                urlretrieve(url, str(partpath))
+                try:
+                    os.replace(partpath, filepath)
+                except (PermissionError, FileExistsError):
+                    # Another process finished this file first and may hold it open (Windows);
+                    # keep its copy and discard ours
+                    if not filepath.exists():
+                        raise
+            finally:
+                if partpath.exists():
+                    partpath.unlink()
 
     return dataset_folder
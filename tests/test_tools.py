@@ -1,9 +1,12 @@
+import os
 import unittest.mock
+from pathlib import Path
 
 import pytest
 import requests
 
 from parcels import download_example_dataset, list_example_datasets
+from parcels.tools.exampledata_utils import example_data_files
 
 
 @pytest.mark.skip(reason="too time intensive")
@@ -46,6 +49,54 @@ def test_download_example_dataset_no_data_home():
     assert dataset_folder_path.name == dataset
 
 
+def test_download_example_dataset_downloads_via_part_file(tmp_path):
+    dataset = list_example_datasets()[0]
+    downloaded_to = []
+
+    def fake_urlretrieve(url, filename):
+        downloaded_to.append(Path(filename))
+        Path(filename).write_bytes(b"data")
+
+    with unittest.mock.patch("parcels.tools.exampledata_utils.urlretrieve", new=fake_urlretrieve):
+        dataset_folder_path = download_example_dataset(dataset, data_home=tmp_path)
+
+    assert all(p.name.endswith(f".{os.getpid()}.part") for p in downloaded_to)
+    expected_files = set(example_data_files[dataset])
+    assert {p.name for p in dataset_folder_path.iterdir()} == expected_files
+    assert all((dataset_folder_path / f).read_bytes() == b"data" for f in expected_files)
+
+
+def test_download_example_dataset_failed_download_leaves_no_files(tmp_path):
+    dataset = list_example_datasets()[0]
+
+    def failing_urlretrieve(url, filename):
+        Path(filename).write_bytes(b"partial")
+        raise OSError("connection lost")
+
+    with unittest.mock.patch("parcels.tools.exampledata_utils.urlretrieve", new=failing_urlretrieve):
+        with pytest.raises(OSError):
+            download_example_dataset(dataset, data_home=tmp_path)
+
+    # neither the <file>.<pid>.part file nor the target file is left behind
+    assert list((tmp_path / dataset).iterdir()) == []
+
+
+def test_download_example_dataset_existing_folder(tmp_path):
+    dataset = list_example_datasets()[0]
+
+    def fake_urlretrieve(url, filename):
+        Path(filename).write_bytes(b"data")
+
+    with unittest.mock.patch("parcels.tools.exampledata_utils.urlretrieve", new=fake_urlretrieve):
+        download_example_dataset(dataset, data_home=tmp_path)
+
+    # files that already exist are not downloaded again
+    with unittest.mock.patch("parcels.tools.exampledata_utils.urlretrieve") as mock_function:
+        dataset_folder_path = download_example_dataset(dataset, data_home=tmp_path)
+    mock_function.assert_not_called()
+    assert {p.name for p in dataset_folder_path.iterdir()} == set(example_data_files[dataset])
+
+
 def mock_urlretrieve(url, filename):
     # send a HEAD request to the URL
     response = requests.head(url)